@@ -8,11 +8,12 @@
 # License: MIT
 
 import argparse
+import csv
 import subprocess
 import math
 import json
 import sys
-import pandas as pd
+import tempfile
 import numpy as np
 
 from .__init__ import __version__ as version
@@ -42,6 +43,45 @@ def run_command(cmd, dry_run=False, verbose=False):
         sys.exit(1)
 
 
+def run_command_stream(cmd, read_stdout, dry_run=False, verbose=False):
+    """
+    Run a command and pass its stdout to a reader function while it runs,
+    instead of collecting the whole output in memory first
+    """
+    if dry_run or verbose:
+        print_stderr("[cmd] " + " ".join(cmd))
+        if dry_run:
+            return None
+
+    # stderr goes to a file, so that the process cannot block on a full pipe
+    # while we are reading stdout
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=stderr, bufsize=1024 * 1024
+        )
+
+        read_error = None
+        try:
+            output = read_stdout(process.stdout)
+        except Exception as e:
+            read_error = e
+        process.stdout.close()
+        process.wait()
+
+        if process.returncode != 0:
+            stderr.seek(0)
+            print_stderr("[error] running command: {}".format(" ".join(cmd)))
+            print_stderr(stderr.read().decode("utf-8"))
+            # the process may have failed only because we stopped reading
+            if read_error is not None:
+                print_stderr("[error] reading output: {}".format(read_error))
+            sys.exit(1)
+
+    if read_error is not None:
+        raise read_error
+    return output
+
+
 class BitrateStats:
     def __init__(
         self,
@@ -80,18 +120,21 @@ class BitrateStats:
         self.max_bitrate = 0
         self.min_bitrate = 0
         self.moving_avg_bitrate = []
-        self.frames = []
         self.bitrate_stats = {}
 
+        # per-frame data, stored as parallel arrays; sizes use a narrow type
+        # to save memory bandwidth, and are summed up as 64 bit
+        self.sizes = np.empty(0, dtype=np.int32)
+        self.pts = np.empty(0, dtype=np.float64)
+        self.durations = np.empty(0, dtype=np.float64)
+        self.is_key = np.empty(0, dtype=bool)
+
         self.rounding_factor = 3
 
-        self._chunks = []
+        self._chunks = np.empty(0, dtype=np.float64)
 
     def calculate_statistics(self):
         self._calculate_frame_sizes()
-        self._calculate_duration()
-        self._calculate_fps()
-        self._calculate_max_min_bitrate()
         self._assemble_bitrate_statistics()
 
     def _calculate_frame_sizes(self):
@@ -110,85 +153,97 @@ class BitrateStats:
             self.stream_type[0] + ":0",
             "-show_packets",
             "-show_entries",
-            "packet=pts_time,dts_time,duration_time,size,flags",
+            "packet=pts_time,duration_time,size,flags",
             "-of",
-            "json",
+            "csv=p=0",
             self.input_file,
         ]
 
-        stdout, _ = run_command(cmd, self.dry_run)
+        df = run_command_stream(cmd, BitrateStats._read_packets, self.dry_run)
         if self.dry_run:
             print_stderr("Aborting prematurely, dry-run specified")
             sys.exit(0)
 
-        info = json.loads(stdout)["packets"]
-
-        ret = []
-        idx = 1
-
-        default_duration = next(
-            (x["duration_time"] for x in info if "duration_time" in x.keys()), "NaN"
-        )
-
-        for packet_info in info:
-            frame_type = "I" if packet_info["flags"] == "K_" else "Non-I"
-
-            if "pts_time" in packet_info.keys():
-                pts = float(packet_info["pts_time"])
-            else:
-                pts = "NaN"
-
-            if "duration_time" in packet_info.keys():
-                duration = float(packet_info["duration_time"])
-            else:
-                duration = default_duration
-
-            ret.append(
-                {
-                    "n": idx,
-                    "frame_type": frame_type,
-                    "pts": pts,
-                    "size": int(packet_info["size"]),
-                    "duration": duration,
-                }
-            )
-            idx += 1
+        return self._set_frames(df)
 
-        # fix for missing durations, estimate it via PTS
-        if default_duration == "NaN":
-            ret = self._fix_durations(ret)
-
-        self.frames = ret
-        return ret
+    def _set_frames(self, packets):
+        """
+        Store the packet info read by _read_packets as per-frame arrays
+        """
+        self.sizes = packets["size"].to_numpy()
+        self.pts = packets["pts_time"].to_numpy()
+        self.durations = packets["duration_time"].to_numpy(copy=True)
+        # compare the flags as fixed-width bytes rather than as Python strings
+        self.is_key = packets["flags"].to_numpy(dtype="S") == b"K_"
+
+        # fill missing durations with the first known one, or
+        # estimate them via PTS if no packet has a duration
+        missing_durations = np.isnan(self.durations)
+        if missing_durations.all():
+            self._fix_durations()
+        elif missing_durations.any():
+            default_duration = self.durations[~missing_durations][0]
+            self.durations[missing_durations] = default_duration
+
+        return self.sizes
 
-    def _fix_durations(self, ret):
+    @staticmethod
+    def _read_packets(packets_csv):
         """
-        Calculate durations based on delta PTS
+        Read the CSV packet info from ffprobe into a DataFrame.
+        Fields are printed in ffprobe's order, not the order of -show_entries.
         """
-        last_duration = None
-        for i in range(len(ret) - 1):
-            curr_pts = ret[i]["pts"]
-            next_pts = ret[i+1]["pts"]
-            if next_pts < curr_pts:
-                print_stderr("Non-monotonically increasing PTS, duration/bitrate may be invalid")
-            last_duration = next_pts - curr_pts
-            ret[i]["duration"] = last_duration
-        ret[-1]["duration"] = last_duration
-        return ret
-
-    def _calculate_duration(self):
+        # imported here, so that --help and dry runs do not pay for it
+        import pandas as pd
+
+        return pd.read_csv(
+            packets_csv,
+            header=None,
+            names=["pts_time", "duration_time", "size", "flags"],
+            dtype={
+                "pts_time": np.float64,
+                "duration_time": np.float64,
+                "size": np.int32,
+                "flags": str,
+            },
+            na_values=["N/A", ""],
+            keep_default_na=False,
+        )
+
+    @property
+    def frames(self):
         """
-        Sum of all duration entries
+        Per-frame data as a list of dicts, only built when requested
         """
-        self.duration = round(sum(f["duration"] for f in self.frames), 2)
-        return self.duration
+        return [
+            {
+                "n": idx,
+                "frame_type": "I" if is_key else "Non-I",
+                "pts": pts,
+                "size": size,
+                "duration": duration,
+            }
+            for idx, (is_key, pts, size, duration) in enumerate(
+                zip(
+                    self.is_key.tolist(),
+                    self.pts.tolist(),
+                    self.sizes.tolist(),
+                    self.durations.tolist(),
+                ),
+                start=1,
+            )
+        ]
 
-    def _calculate_fps(self):
+    def _fix_durations(self):
         """
-        FPS = number of frames divided by duration. A rough estimate.
+        Calculate durations based on delta PTS
         """
-        self.fps = len(self.frames) / self.duration
-        return self.fps
+        delta_pts = np.diff(self.pts)
+        if (delta_pts < 0).any():
+            print_stderr("Non-monotonically increasing PTS, duration/bitrate may be invalid")
+        # the last frame gets the same duration as the one before
+        self.durations = np.concatenate([delta_pts, delta_pts[-1:]])
+        return self.durations
 
     def _collect_chunks(self):
         """
@@ -201,74 +256,80 @@ class BitrateStats:
         if self.verbose:
             print_stderr("Collecting chunks for bitrate calculation")
 
-        # this is where we will store the stats in buckets
-        aggregation_chunks = []
-        curr_list = []
-
+        # this is where we will store the stats in buckets,
+        # represented by the index of the first frame in each bucket
         if self.aggregation == "gop":
-            # collect group of pictures, each one containing all frames belonging to it
-            for frame in self.frames:
-                if frame["frame_type"] != "I":
-                    curr_list.append(frame)
-                if frame["frame_type"] == "I":
-                    if curr_list:
-                        aggregation_chunks.append(curr_list)
-                    curr_list = [frame]
-            # flush the last one
-            aggregation_chunks.append(curr_list)
+            # collect group of pictures, each one starting with an I-frame;
+            # leading non-I frames form a group of their own
+            chunk_starts = np.flatnonzero(self.is_key)
+            if not len(chunk_starts) or chunk_starts[0] != 0:
+                chunk_starts = np.r_[0, chunk_starts]
 
         else:
-            # per-time aggregation
-            agg_time = 0
-            for frame in self.frames:
-                if agg_time < self.chunk_size:
-                    curr_list.append(frame)
-                    agg_time += float(frame["duration"])
+            # per-time aggregation: a chunk ends with the first frame whose
+            # duration makes the chunk reach the chunk size
+            num_frames = len(self.durations)
+            chunk_starts = []
+            curr_start = 0
+            window = 64
+            while curr_start < num_frames:
+                chunk_starts.append(curr_start)
+                # sum up the durations of each chunk from zero, in a window that
+                # grows until it contains the end of the chunk
+                while True:
+                    chunk_durations = np.cumsum(
+                        self.durations[curr_start : curr_start + window]
+                    )
+                    chunk_ends = np.flatnonzero(~(chunk_durations < self.chunk_size))
+                    if len(chunk_ends) or curr_start + window >= num_frames:
+                        break
+                    window *= 2
+                if len(chunk_ends):
+                    curr_start += chunk_ends[0] + 1
                 else:
-                    if curr_list:
-                        aggregation_chunks.append(curr_list)
-                    curr_list = [frame]
-                    agg_time = float(frame["duration"])
-            aggregation_chunks.append(curr_list)
+                    curr_start = num_frames
 
         # calculate BR per group
-        self._chunks = [
-            BitrateStats._bitrate_for_frame_list(x) for x in aggregation_chunks if len(x) > 1
-        ]
+        self._chunks = BitrateStats._bitrate_for_chunks(
+            self.sizes, self.pts, np.asarray(chunk_starts, dtype=np.int64)
+        )
 
         return self._chunks
 
     @staticmethod
-    def _bitrate_for_frame_list(frame_list):
+    def _bitrate_for_chunks(sizes, pts, chunk_starts):
         """
-        Given a list of frames with size and PTS, get the bitrate,
-        which is done by dividing size through Δ time.
+        Given the sizes and PTS of all frames and the index of the first frame
+        of every chunk, get the bitrate per chunk, which is done by dividing
+        size through Δ time. Chunks with only one frame are skipped.
         """
-        if len(frame_list) > 1:
-            size = sum(f["size"] for f in frame_list)
-            times = [f["pts"] for f in frame_list]
-            sum_delta_time = sum(float(curr) - float(prev) for curr, prev in zip(times[1:], times))
-            bitrate = ((size * 8) / 1000) / sum_delta_time
+        chunk_ends = np.r_[chunk_starts[1:], len(sizes)]
+        size_per_chunk = np.add.reduceat(sizes, chunk_starts, dtype=np.int64)
+        delta_time_per_chunk = pts[chunk_ends - 1] - pts[chunk_starts]
 
-            return bitrate
-
-    def _calculate_max_min_bitrate(self):
-        """
-        Find the min/max from the chunks
-        """
-        self.max_bitrate = max(self._collect_chunks())
-        self.min_bitrate = min(self._collect_chunks())
-        return self.max_bitrate, self.min_bitrate
+        valid_chunks = chunk_ends - chunk_starts > 1
+        return (
+            (size_per_chunk[valid_chunks] * 8) / 1000
+        ) / delta_time_per_chunk[valid_chunks]
 
     def _assemble_bitrate_statistics(self):
         """
-        Assemble all pre-calculated statistics plus some "easy" ones.
-        """
+        Calculate all statistics from the frame data and the chunk bitrates.
 
+        The duration is the sum of all duration entries, and FPS is the number of
+        frames divided by the duration (a rough estimate).
+        """
+        num_frames = len(self.sizes)
+        self.duration = round(float(self.durations.sum()), 2)
+        self.fps = num_frames / self.duration
         self.avg_bitrate = (
-            sum(f["size"] for f in self.frames) * 8 / 1000
+            float(self.sizes.sum(dtype=np.int64)) * 8 / 1000
         ) / self.duration
-        self.avg_bitrate_over_chunks = np.mean(self._collect_chunks())
+
+        chunks = self._collect_chunks()
+        self.max_bitrate = float(chunks.max())
+        self.min_bitrate = float(chunks.min())
+        self.avg_bitrate_over_chunks = float(chunks.mean())
 
         self.max_bitrate_factor = self.max_bitrate / self.avg_bitrate
 
@@ -277,7 +338,7 @@ class BitrateStats:
             "input_file": self.input_file,
             "stream_type": self.stream_type,
             "avg_fps": round(self.fps, self.rounding_factor),
-            "num_frames": len(self.frames),
+            "num_frames": num_frames,
             "avg_bitrate": round(self.avg_bitrate, self.rounding_factor),
             "avg_bitrate_over_chunks": round(
                 self.avg_bitrate_over_chunks, self.rounding_factor
@@ -285,9 +346,7 @@ class BitrateStats:
             "max_bitrate": round(self.max_bitrate, self.rounding_factor),
             "min_bitrate": round(self.min_bitrate, self.rounding_factor),
             "max_bitrate_factor": round(self.max_bitrate_factor, self.rounding_factor),
-            "bitrate_per_chunk": [
-                round(b, self.rounding_factor) for b in self._collect_chunks()
-            ],
+            "bitrate_per_chunk": np.round(chunks, self.rounding_factor).tolist(),
             "aggregation": self.aggregation,
             "chunk_size": self.chunk_size,
             "duration": round(self.duration, self.rounding_factor),
@@ -303,13 +362,23 @@ class BitrateStats:
             self._print_json()
 
     def _print_csv(self):
-        df = pd.DataFrame(self.bitrate_stats)
-        df.reset_index(level=0, inplace=True)
-        df.rename(index=str, columns={"index": "chunk_index"}, inplace=True)
-        cols = df.columns.tolist()
-        cols.insert(0, cols.pop(cols.index("input_file")))
-        df = df.reindex(columns=cols)
-        print(df.to_csv(index=False))
+        """
+        Print one row per chunk, repeating the overall statistics in every row
+        """
+        columns = [k for k in self.bitrate_stats.keys() if k != "input_file"]
+        row = [self.bitrate_stats["input_file"], None] + [
+            self.bitrate_stats[k] for k in columns
+        ]
+        bitrate_column = 2 + columns.index("bitrate_per_chunk")
+
+        writer = csv.writer(sys.stdout, lineterminator="\n")
+        writer.writerow(["input_file", "chunk_index"] + columns)
+        for chunk_index, chunk_bitrate in enumerate(
+            self.bitrate_stats["bitrate_per_chunk"]
+        ):
+            row[1] = chunk_index
+            row[bitrate_column] = chunk_bitrate
+            writer.writerow(row)
 
     def _print_json(self):
         print(json.dumps(self.bitrate_stats, indent=4))
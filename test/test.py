@@ -2,8 +2,11 @@
 
 import os
 import sys
+import io
 import json
 
+import numpy as np
+
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 
 from ffmpeg_bitrate_stats import __main__ as main
@@ -41,6 +44,28 @@ test_files = {
 }
 
 
+def synthetic_stats(sizes, pts, durations=None, is_key=None, **kwargs):
+    """
+    Create a BitrateStats object from per-frame values, passing them through
+    the same CSV parsing as ffprobe output, without running ffprobe
+    """
+    if durations is None:
+        durations = [None] * len(sizes)
+    if is_key is None:
+        is_key = [False] * len(sizes)
+
+    packets_csv = "".join(
+        "{:.6f},{},{},{}\n".format(
+            p, "N/A" if d is None else "{:.6f}".format(d), s, "K_" if k else "__"
+        )
+        for s, p, d, k in zip(sizes, pts, durations, is_key)
+    )
+
+    br = main.BitrateStats("synthetic", **kwargs)
+    br._set_frames(main.BitrateStats._read_packets(io.StringIO(packets_csv)))
+    return br
+
+
 class TestBitrates:
     def test_output(self):
         """
@@ -62,3 +87,67 @@ class TestBitrates:
             del output["input_file"]
 
             assert output == expected_output
+
+    def test_time_chunks_at_25_fps(self):
+        """
+        Every time chunk of a 25 fps stream holds 25 frames
+        """
+        num_frames = 300
+        br = synthetic_stats(
+            sizes=[1000] * num_frames,
+            pts=np.arange(num_frames) / 25,
+            durations=[0.04] * num_frames,
+        )
+
+        chunks = br._collect_chunks()
+
+        # 25 frames of 8 kbit over 24 frame intervals; 26 frames would give 208.0
+        assert np.round(chunks, 3).tolist() == [208.333] * 12
+
+    def test_time_chunks(self):
+        """
+        A time chunk ends with the frame that makes it reach the chunk size
+        """
+        br = synthetic_stats(
+            sizes=[1000, 2000, 500, 4000, 800, 1200, 3000, 600, 700, 900],
+            pts=[0.0, 0.1, 0.3, 0.4, 0.7, 0.8, 0.9, 1.1, 1.2, 1.3],
+            durations=[0.1, 0.2, 0.1, 0.3, 0.1, 0.1, 0.2, 0.1, 0.1, 0.2],
+            chunk_size=0.35,
+        )
+
+        chunks = br._collect_chunks()
+
+        assert np.round(chunks, 3).tolist() == [93.333, 128.0, 128.0, 128.0]
+
+    def test_time_chunks_with_negative_durations(self):
+        """
+        Durations estimated from non-monotonic PTS can be negative
+        """
+        br = synthetic_stats(
+            sizes=[1000, 2000, 3000, 4000, 5000, 6000],
+            pts=[0.0, 0.04, 0.12, 0.16, 0.08, 0.2],
+            chunk_size=0.1,
+        )
+
+        chunks = br._collect_chunks()
+
+        assert (br.durations < 0).any()
+        assert np.round(chunks, 3).tolist() == [600.0, 1800.0]
+
+    def test_gop_chunks(self):
+        """
+        Leading non-I frames form a GOP of their own, and GOPs with only
+        one frame are skipped
+        """
+        is_key = [False, False, True, False, False, True, True, False, True]
+        br = synthetic_stats(
+            sizes=[1000, 2000, 9000, 1000, 1500, 8000, 7000, 500, 6000],
+            pts=np.arange(len(is_key)) * 0.04,
+            durations=[0.04] * len(is_key),
+            is_key=is_key,
+            aggregation="gop",
+        )
+
+        chunks = br._collect_chunks()
+
+        assert np.round(chunks, 3).tolist() == [600.0, 1150.0, 1500.0]